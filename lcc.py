@@ -2,19 +2,85 @@
 
 from dotenv import load_dotenv
 import os
+import sys
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 from collections import Counter
+from typing import Iterator, NamedTuple
 import time
-import time
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 load_dotenv()
 
+USERS_BATCH_SIZE = 300
+STREAM_CHUNK_SIZE = 64 * 1024
+# Seconds to wait for a connection or for the next bytes of a response; for the games stream this is per chunk, not in total
+REQUEST_TIMEOUT = 30
+# Seconds to wait before retrying a request that was rate limited (HTTP 429)
+RATE_LIMIT_WAIT = 60
+PROGRESS_FORMAT = "  {percent:.0f}% complete ({games} games) \r"
+# Only the players, winner and status of each game are used, so everything else is left out of the game stream
+GAME_STREAM_PARAMS = {
+    'moves': 'false',
+    'pgnInJson': 'false',
+    'tags': 'false',
+    'clocks': 'false',
+    'evals': 'false',
+    'opening': 'false',
+    'literate': 'false'
+}
+FLAG_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'lcc', 'flags.json')
+FLAG_CACHE_TTL = 30 * 24 * 60 * 60
+flag_cache = {}
+
 api_key = os.getenv("OAUTH_2_LICHESS_KEY")
 if not api_key:
     raise ValueError("API key not found. Please set OAUTH_2_LICHESS_KEY in your environment variables.")
 
+ACCOUNT_URL = 'https://lichess.org/api/account'
+USER_URL = 'https://lichess.org/api/user/%s'
+USERS_URL = 'https://lichess.org/api/users'
+GAMES_URL = 'https://lichess.org/api/games/user/%s'
+
+# The Authorization header is sent by the session, so only the content types differ between requests
+JSON_HEADERS = {'Accept': 'application/json'}
+NDJSON_HEADERS = {'Accept': 'application/x-ndjson'}
+USERS_HEADERS = {'Accept': 'application/json', 'Content-Type': 'text/plain'}
+
+class RateLimitRetry(Retry):
+    """A Retry policy that waits at least RATE_LIMIT_WAIT seconds after a 429 response, as Lichess asks API clients to.
+    A longer Retry-After header is still honoured; other retryable statuses use the usual exponential backoff."""
+    def sleep(self, response=None):
+        if response is not None and response.status == 429:
+            time.sleep(max(self.get_retry_after(response) or 0, RATE_LIMIT_WAIT))
+            return
+        super().sleep(response)
+
+# A single session keeps the connection to lichess.org alive across requests instead of re-doing the TLS handshake
+session = requests.Session()
+session.headers.update({'Authorization': f'Bearer {api_key}'})
+# Lichess asks API clients to only make one request at a time, so a single kept-alive connection is all that's needed
+session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=1,
+    # A 429 is retried at most 3 times, a minute apart; 5xx responses are retried at most 3 times, after 0, 2 and 4 seconds
+    max_retries=RateLimitRetry(
+        total=5,
+        status=3,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['GET', 'POST']),
+        respect_retry_after_header=True,
+        raise_on_status=False)))
+
 parser = argparse.ArgumentParser(
                     prog='python lcc.py',
                     description='\'Lichess Country Counter\' counts the number of games played against each country on Lichess.',
@@ -49,49 +115,55 @@ group.add_argument(
     help="Analyze all games"
 )
 
+class GameSummary(NamedTuple):
+    """The relevant information of a single game, as seen from the analysed user's side.
+    opponent_flag is only filled in once the opponents' flags have been fetched."""
+    id: str
+    perf: str
+    opponent: str
+    opponent_id: str
+    opponent_rating: int
+    winner: str
+    status: str
+    color: str
+    opponent_color: str
+    opponent_flag: str = 'Unknown'
+
 class SimpleTimeEstimator:
     def __init__(self, username, max_games, all=False, is_quiet=False):
         self.current_games_analysed = 0
         self.games_to_analyse, self.seconds_estimate = self.estimate_time_to_completion(username, max_games, all, is_quiet)
-        self.games_to_analyse, self.seconds_estimate = self.estimate_time_to_completion(username, max_games, all, is_quiet)
-        self.current_update_benchmark = 0.05
-        self.benchmark_increment = 0.05
-        self.start_time = time.time()
+        # Progress is reported every 5% of the games, and at least every 100 games
+        self.update_interval = max(1, min(100, int(self.games_to_analyse * 0.05)))
+        self.next_update_at = self.update_interval
         self.start_time = time.time()
   
     def estimate_time_to_completion(self, username, max_games: int, all=False, is_quiet=False):
         try:
-            base_url = f'https://lichess.org/api/user/{username}'
-            headers = {
-                'Accept': 'application/json',
-                'Authorization': f'Bearer {api_key}'
-            }
-            response = requests.get(base_url, headers=headers)
-            if response.status_code == 200:
-                if all:
-                    max_games = response.json()['count']['all']
-                seconds = max_games / (10/3)
-                seconds = max_games / (10/3)
-                return max_games, seconds
-            else:
-                response.raise_for_status()
+            response = session.get(USER_URL % username, headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            if all:
+                max_games = json_loads(response.content)['count']['all']
+            # Lichess streams games to authenticated users at roughly 30 games per second
+            seconds = max_games / 30
+            return max_games, seconds
         except requests.HTTPError as e:
             if not is_quiet:
                 if e.response.status_code == 404:
                     print(f"An error occurred. Please verify that user '{username}' exists.")
                 print(e.response.text)
-            if not is_quiet:
-                if e.response.status_code == 404:
-                    print(f"An error occurred. Please verify that user '{username}' exists.")
-                print(e.response.text)
-            exit(e.response.status_code)
+            raise
             
     def update(self, games_analysed, is_quiet=False):
         self.current_games_analysed = games_analysed
-        if ((games_analysed / self.games_to_analyse)) >= self.current_update_benchmark or games_analysed % 100 == 0:
-            if not is_quiet:
-                print(f"  {games_analysed / self.games_to_analyse * 100:.0f}% complete ({self.current_games_analysed} games) ", end='\r')
-            self.current_update_benchmark += self.benchmark_increment
+        if games_analysed < self.next_update_at:
+            return
+        self.next_update_at += self.update_interval
+        if is_quiet:
+            return
+        sys.stdout.write(PROGRESS_FORMAT.format(percent=games_analysed / self.games_to_analyse * 100, games=games_analysed))
+        # The line ends with a carriage return rather than a newline, so it would otherwise sit in the buffer
+        sys.stdout.flush()
     
 def _extract_games(username: str, count):
     """Extract the latest game of a Lichess user. This function is for testing purposes only.
@@ -99,139 +171,172 @@ def _extract_games(username: str, count):
     Args:
         username (str): The Lichess username to extract the latest game from.
         count (int): The number of games to extract."""
-    base_url = f'https://lichess.org/api/games/user/{username}'
-    headers = {
-        'Accept': 'application/x-ndjson',
-        'Authorization': f'Bearer {api_key}'
-    }
-    response = requests.get(base_url, headers=headers, params={'max': count}, stream=True)
-    
-    if response.status_code == 200:
-        games = []
-        for raw_game_data in response.iter_lines():
-            if raw_game_data:
-                game = json.loads(raw_game_data.decode('utf-8'))
-                processed_game = process_game(username, game)
-                games.append(processed_game)
-        return games
-    else:
-        response.raise_for_status()
+    games = list(iter_games(username, max=count))
+    flags = fetch_player_flags({game.opponent_id for game in games})
+    return [game._replace(opponent_flag=flags.get(game.opponent_id, 'Unknown')) for game in games]
 
 def _print_games(games):
     for game in games:
         print(game)
         print()
 
+def iter_games(username: str, **params) -> Iterator[GameSummary]:
+    """Stream the games of a Lichess user, yielding each one as processed by process_game. Flags are not included.
+    Possible query parameters available at https://lichess.org/api#tag/Games/operation/apiGamesUser
+    
+    Args:
+        username (str): The Lichess username to download games from.
+        **params: Additional query parameters, which take precedence over GAME_STREAM_PARAMS"""
+    # Closing the response when the generator finishes or fails frees the connection for the flag lookups
+    with session.get(GAMES_URL % username, headers=NDJSON_HEADERS, params={**GAME_STREAM_PARAMS, **params}, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if not response.ok:
+            # Read the error body now, as it can't be read once the with block has closed the response
+            response.content
+            response.raise_for_status()
+        # User ids are the lowercase form of usernames, so this also matches usernames typed with different capitalisation
+        user_id = username.lower()
+        for raw_game_data in response.iter_lines(chunk_size=STREAM_CHUNK_SIZE, delimiter=b'\n'):
+            if raw_game_data:
+                yield process_game(user_id, json_loads(raw_game_data))
+
 def process_games(username: str, estimator: SimpleTimeEstimator, return_games=False, is_quiet=False, **params):
     """Download the games of a Lichess user.
     Possible query parameters available at https://lichess.org/api#tag/Games/operation/apiGamesUser
     
     Args:
         username (str): The Lichess username to download games from.
-        **params: Additional query parameters"""
-    base_url = f'https://lichess.org/api/games/user/{username}'
-    headers = {
-        'Accept': 'application/x-ndjson',
-        'Authorization': f'Bearer {api_key}'
-    }
+        **params: Additional query parameters, which take precedence over GAME_STREAM_PARAMS"""
+    # Only unique opponents are stored, so memory doesn't grow with the number of games
+    opponent_counts = Counter()
+    games = []
+    rating_sum = 0
+    games_count = 0
     try:
-        response = requests.get(base_url, headers=headers, params=params, stream=True)
-        avg_opponent_rating = 0
-        results = Counter()
-        games = []
-        for games_analysed_count, raw_game_data in enumerate(response.iter_lines(), start=1):
-            if raw_game_data:
-                game = json.loads(raw_game_data.decode('utf-8'))
-                game_data = process_game(username, game)
-                avg_opponent_rating += ((game_data['opponent_rating'] - avg_opponent_rating) / games_analysed_count)
-                flag = game_data['opponent_flag']
-                if flag not in results:
-                    results[flag] = 1
-                else:
-                    results[flag] += 1
-                if return_games:
-                    games.append(game_data)
-            estimator.update(games_analysed_count, is_quiet)
-            estimator.update(games_analysed_count, is_quiet)
-        if return_games:
-            return games, results, avg_opponent_rating
-        else:
-            return results, avg_opponent_rating
+        for game_data in iter_games(username, **params):
+            games_count += 1
+            rating_sum += game_data.opponent_rating
+            opponent_counts[game_data.opponent_id] += 1
+            if return_games:
+                games.append(game_data)
+            estimator.update(games_count, is_quiet)
     except requests.HTTPError as e:
         if not is_quiet:
-            print(f"Analysed {estimator.current_games_analysed} games before receiving Error {response.status_code}.")
-            print(e.response.text)
-        if not is_quiet:
-            print(f"Analysed {estimator.current_games_analysed} games before receiving Error {response.status_code}.")
+            print(f"Analysed {estimator.current_games_analysed} games before receiving Error {e.response.status_code}.")
             print(e.response.text)
     except Exception as e:
+        if not is_quiet:
             print(f"Analysed {estimator.current_games_analysed} games before receiving Error.")
             print(e)
-    return results, avg_opponent_rating
+    # The games read before any error above are still counted.
+    # Flags are only looked up once the games stream is finished, so that only one request is open at a time.
+    try:
+        fetch_player_flags(opponent_counts)
+    except (requests.RequestException, ValueError) as e:
+        if not is_quiet:
+            print("Could not fetch all opponents' flags; their games are counted as 'Unknown'.")
+            print(e)
+    # Batches fetched before a failure are already in the flag cache
+    flags = {opponent: flag_cache[opponent][0] for opponent in opponent_counts if opponent in flag_cache}
+    avg_opponent_rating = rating_sum / games_count if games_count else 0
+    results = Counter()
+    for opponent, games_played in opponent_counts.items():
+        results[flags.get(opponent, 'Unknown')] += games_played
+    if return_games:
+        games = [game_data._replace(opponent_flag=flags.get(game_data.opponent_id, 'Unknown')) for game_data in games]
+        return games, results, avg_opponent_rating
+    else:
+        return results, avg_opponent_rating
 
-def process_game(username: str, game):
-    """Process a user's game to extract only the relevant information. Returns as a dictionary.
+def process_game(user_id: str, game: dict) -> GameSummary:
+    """Process a user's game to extract only the relevant information. Returns as a GameSummary.
     
     Args:
-        username (str): The username of the player whose game is being processed.
+        user_id (str): The id (lowercase username) of the player whose game is being processed.
         game: a JSON object representing a game."""
     
-    color, opponent_color = process_player_colors(game, username)
-    opponent_rating = game['players'][opponent_color]['rating']
-    opponent_name = game['players'][opponent_color]['user']['name']
-    try:
-        winner_name = game['players'][game['winner']]['user']['name']
-    except KeyError:
-        winner_name = 'Unknown'
-    return {
-        'id': game['id'],
-        'perf': game['perf'],
-        'opponent': opponent_name,
-        'opponent_rating': opponent_rating,
-        'opponent_flag': extract_player_flag(opponent_name),
-        'winner': winner_name,
-        'status': game['status'],
-        'color': color,
-        'opponent_color': opponent_color,
-        'opponent_rating': opponent_rating
-    }
+    players = game['players']
+    color, opponent_color = ('white', 'black') if players['white']['user']['id'] == user_id else ('black', 'white')
+    opponent = players[opponent_color]
+    opponent_rating = opponent['rating']
+    opponent_user = opponent['user']
+    # Draws and aborted games have no winner
+    winner = game.get('winner')
+    winner_name = players[winner]['user']['name'] if winner else 'Unknown'
+    return GameSummary(
+        id=game['id'],
+        perf=game['perf'],
+        opponent=opponent_user['name'],
+        opponent_id=opponent_user['id'],
+        opponent_rating=opponent_rating,
+        winner=winner_name,
+        status=game['status'],
+        color=color,
+        opponent_color=opponent_color
+    )
 
-def extract_player_flag(username: str, is_quiet=False):
-    """Extract the country flag of a Lichess user.
+def extract_player_flag(user_data: dict) -> str:
+    """Extract the country flag from a Lichess user's profile data.
     
     Args:
-        username (str): The Lichess username to extract the flag from."""
-    base_url = f'https://lichess.org/api/user/{username}'
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {api_key}'
-    }
+        user_data: a JSON object representing a Lichess user."""
+    return user_data.get('profile', {}).get('flag', 'Unknown')
+
+def fetch_player_flags(user_ids):
+    """Fetch the country flags of several Lichess users. Returns a dictionary mapping each user id to its flag.
+    Users that were already looked up are served from the flag cache; the rest are fetched in batches of up to 300 per request,
+    as allowed by https://lichess.org/api#tag/Users/operation/apiUsers
+    
+    Args:
+        user_ids: the ids (lowercase usernames) of the Lichess users to fetch the flags of."""
+    user_ids = set(user_ids)
+    missing = [user_id for user_id in user_ids if user_id not in flag_cache]
+    for i in range(0, len(missing), USERS_BATCH_SIZE):
+        fetched_at = time.time()
+        batch_flags = _fetch_flags_batch(missing[i:i + USERS_BATCH_SIZE])
+        flag_cache.update({user_id: (flag, fetched_at) for user_id, flag in batch_flags.items()})
+    return {user_id: flag_cache[user_id][0] for user_id in user_ids if user_id in flag_cache}
+
+def _fetch_flags_batch(user_ids):
+    """Fetch the country flags of up to 300 Lichess users in a single request.
+    
+    Args:
+        user_ids: the ids (lowercase usernames) of the Lichess users to fetch the flags of."""
+    response = session.post(USERS_URL, headers=USERS_HEADERS, data=','.join(user_ids), timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    # Closed accounts are left out of the response; they are remembered as 'Unknown' so they aren't requested again
+    flags = dict.fromkeys(user_ids, 'Unknown')
+    for user_data in json_loads(response.content):
+        flags[user_data['id']] = extract_player_flag(user_data)
+    return flags
+
+def load_flag_cache():
+    """Load the flags fetched by previous runs from disk, skipping those older than FLAG_CACHE_TTL."""
     try:
-        response = requests.get(base_url, headers=headers)
-        user_data = response.json()
-        try:
-            return user_data['profile']['flag']
-        except KeyError:
-            return 'Unknown'
-    except requests.HTTPError as e:
-        if not is_quiet:
-            print(f'Error: {response.status_code}')
-            response.raise_for_status()
-        if not is_quiet:
-            print(f'Error: {response.status_code}')
-            response.raise_for_status()
+        with open(FLAG_CACHE_PATH, encoding='utf-8') as cache_file:
+            cached_flags = json.load(cache_file)
+    except (OSError, ValueError):
+        return
+    # A cache file of the wrong shape is ignored like an unreadable one, and malformed entries are skipped
+    if not isinstance(cached_flags, dict):
+        return
+    now = time.time()
+    for user_id, entry in cached_flags.items():
+        if not (isinstance(entry, list) and len(entry) == 2):
+            continue
+        flag, fetched_at = entry
+        if not isinstance(flag, str) or isinstance(fetched_at, bool) or not isinstance(fetched_at, (int, float)):
+            continue
+        if now - fetched_at < FLAG_CACHE_TTL:
+            flag_cache[user_id] = (flag, fetched_at)
 
-def process_player_colors(game, username):
-    white_name = game['players']['white']['user']['name']    
-    color = ''
-    opponent_color = ''
-    if white_name == username:
-        color = 'white'
-        opponent_color = 'black'
-    else:
-        color = 'black'
-        opponent_color = 'white'   
-    return color, opponent_color
+def save_flag_cache():
+    """Save the flag cache to disk so that later runs can skip looking up known opponents."""
+    try:
+        os.makedirs(os.path.dirname(FLAG_CACHE_PATH), exist_ok=True)
+        with open(FLAG_CACHE_PATH, 'w', encoding='utf-8') as cache_file:
+            json.dump(flag_cache, cache_file)
+    except OSError:
+        pass
 
 def process_results(results: Counter, n: int, hide_unknown: bool):
     if hide_unknown:
@@ -242,34 +347,37 @@ def process_results(results: Counter, n: int, hide_unknown: bool):
         results = results.most_common()
     return results
 def verify_auth():
-    url = "https://lichess.org/api/account"
-    headers = {
-        'Authorization': f'Bearer {api_key}'
-    }
-    response = requests.get(url, headers=headers)
+    response = session.get(ACCOUNT_URL, timeout=REQUEST_TIMEOUT)
     if response.status_code != 200:
         print("Error. Status code ", response.status_code)
         exit(response.status_code)
         
 def execute_workflow():
     args = parser.parse_args()
-    verify_auth()
-    is_quiet = args.quiet
-    estimator = SimpleTimeEstimator(args.username, args.max_games, args.all, is_quiet)
-    
-    if estimator.seconds_estimate:
-        if not is_quiet:
-            print (f"Loading... Estimated time to analyze {estimator.games_to_analyse} games: {estimator.seconds_estimate:.0f} seconds.")
-        if args.all:
-            flag_counts, avg_rating = process_games(username=args.username, estimator=estimator, is_quiet=is_quiet, moves=False)
-        else:
-            flag_counts, avg_rating = process_games(username=args.username, estimator=estimator, is_quiet=is_quiet, max=args.max_games, moves=False)
-        flag_counts = process_results(flag_counts, args.number, args.hide_unknown)
-        if not is_quiet:
-            print(' ', end='\r')
-            print(f"Done! Time: {time.time() - estimator.start_time:.0f} seconds.".ljust(50))
-            print(f"Avg. Rating: {avg_rating:.0f}")
-        print(flag_counts)           
+    load_flag_cache()
+    try:
+        verify_auth()
+        is_quiet = args.quiet
+        estimator = SimpleTimeEstimator(args.username, args.max_games, args.all, is_quiet)
+        
+        if estimator.seconds_estimate:
+            if not is_quiet:
+                print (f"Loading... Estimated time to analyze {estimator.games_to_analyse} games: {estimator.seconds_estimate:.0f} seconds.")
+            if args.all:
+                flag_counts, avg_rating = process_games(username=args.username, estimator=estimator, is_quiet=is_quiet)
+            else:
+                flag_counts, avg_rating = process_games(username=args.username, estimator=estimator, is_quiet=is_quiet, max=args.max_games)
+            flag_counts = process_results(flag_counts, args.number, args.hide_unknown)
+            if not is_quiet:
+                print(' ', end='\r')
+                print(f"Done! Time: {time.time() - estimator.start_time:.0f} seconds.".ljust(50))
+                print(f"Avg. Rating: {avg_rating:.0f}")
+            print(flag_counts)
+    except requests.HTTPError as e:
+        exit(e.response.status_code)
+    finally:
+        save_flag_cache()
+        session.close()
              
 def main():
     execute_workflow()